@@ -1,12 +1,137 @@
+import google.ai.generativelanguage as glm
 import google.generativeai as genai
-import json
+from google.api_core import gapic_v1
+import asyncio
+import csv
+import hashlib
+import io
+import logging
+import orjson
 import os
-from typing import Dict, Any
+import re
+from cachetools import TTLCache
+from typing import Dict, Any, List, Optional, Tuple
 from dotenv import load_dotenv
 from app.models import InsightsRequest, InsightsResponse, RiskLevel
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+_KEEPALIVE_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30_000),
+    ("grpc.keepalive_timeout_ms", 10_000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+
+_AsyncTransport = glm.GenerativeServiceAsyncClient.get_transport_class("grpc_asyncio")
+
+
+def _create_keepalive_channel(host, options=(), **kwargs):
+    return _AsyncTransport.create_channel(host, options=[*options, *_KEEPALIVE_OPTIONS], **kwargs)
+
+
+def _keepalive_transport(**kwargs):
+    return _AsyncTransport(channel=_create_keepalive_channel, **kwargs)
+
+
+def _format_number(value: float) -> str:
+    return str(int(value)) if value.is_integer() else str(value)
+
+
+def _format_months(months: int) -> str:
+    return "1 month" if months == 1 else f"{months} months"
+
+
+def _join_clauses(parts: List[str]) -> str:
+    return parts[0] if len(parts) == 1 else f"{', '.join(parts[:-1])} and {parts[-1]}"
+
+
+def _urgency(supplier) -> tuple:
+    urgent = (supplier.contract_expiry_months < 3) + (supplier.on_time_delivery_pct < 90)
+    return (-urgent, supplier.contract_expiry_months, supplier.on_time_delivery_pct)
+
+
+def _add_item(items: List[str], covered: set, keys: List[tuple], text: str) -> None:
+    if keys and any(key in covered for key in keys):
+        return
+    items.append(text)
+    covered.update(keys)
+
+
+_OFFLOAD_THRESHOLD_CHARS = 16 * 1024
+
+_RISK_LEVELS = tuple(level.value for level in RiskLevel)
+_LIST_FIELDS = ("key_risks", "negotiation_levers", "recommended_actions_next_90_days")
+
+_USER_PROMPT_TEMPLATE = """CATEGORY: {category}
+
+SUPPLIER DATA:
+name,spend_usd,otd_pct,expiry_mo,single_source,region
+{suppliers}
+
+Respond with ONLY the JSON object, no other text."""
+
+_JSON_TOKEN_RE = re.compile(r'[{}\[\]"]|\\.?')
+_CLOSERS = {'{': '}', '[': ']'}
+
+
+class _BraceTracker:
+    """Incrementally tracks open JSON objects and arrays, ignoring brackets inside string literals."""
+
+    __slots__ = ("stack", "started", "closed", "in_string", "escaped")
+
+    def __init__(self):
+        self.stack = []
+        self.started = False
+        self.closed = False
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> int:
+        """Consume text and return the index just past the closing top-level brace, or -1."""
+        start = 0
+        if self.escaped:
+            self.escaped = False
+            start = 1
+        for match in _JSON_TOKEN_RE.finditer(text, start):
+            token = match.group()
+            if self.in_string:
+                if token == '"':
+                    self.in_string = False
+                elif token == '\\':
+                    self.escaped = True
+            elif token == '"':
+                self.in_string = self.started
+            elif token == '{':
+                self.stack.append(token)
+                self.started = True
+            elif not self.started:
+                continue
+            elif token == '[':
+                self.stack.append(token)
+            elif self.stack and token == _CLOSERS[self.stack[-1]]:
+                self.stack.pop()
+                if not self.stack:
+                    self.closed = True
+                    return match.end()
+        return -1
+
+    def close(self, text: str) -> str:
+        """Append whatever is needed to terminate the open string, arrays and objects, innermost first."""
+        if self.in_string:
+            if self.escaped:
+                text = text[:-1]
+            text += '"'
+        for opener in reversed(self.stack):
+            text = text.rstrip().rstrip(',')
+            if text.endswith(':'):
+                text += ' null'
+            text += _CLOSERS[opener]
+        return text
+
 
 class LLMService:
     def __init__(self):
@@ -14,6 +139,7 @@ class LLMService:
         if not api_key:
             raise ValueError("GOOGLE_API_KEY not found in environment variables")
         genai.configure(api_key=api_key)
+        self._api_key = api_key
         self.model = genai.GenerativeModel(
             'gemini-2.5-flash',
             generation_config={
@@ -23,6 +149,17 @@ class LLMService:
                 'max_output_tokens': 4096,
             }
         )
+        max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self._prompt_prefix = f"{self._build_system_prompt()}\n\n{self._build_instructions_prompt()}"
+        self.cache = TTLCache(
+            maxsize=int(os.getenv("LLM_CACHE_MAXSIZE", "10000")),
+            ttl=int(os.getenv("LLM_CACHE_TTL_SECONDS", "3600")),
+        )
+
+    def _cache_key(self, request: InsightsRequest) -> str:
+        canonical = orjson.dumps(request.model_dump(), option=orjson.OPT_SORT_KEYS)
+        return hashlib.blake2b(canonical).hexdigest()
     
     def _build_system_prompt(self) -> str:
         return """You are a procurement analytics expert specializing in supplier risk assessment and sourcing strategy for manufacturing companies.
@@ -43,25 +180,17 @@ ANALYSIS FRAMEWORK:
 - Consider geographic diversification
 - Generate concrete, time-bound action items"""
 
-    def _build_user_prompt(self, request: InsightsRequest) -> str:
-        suppliers_json = json.dumps([s.dict() for s in request.suppliers], indent=2)
-        
-        return f"""Analyze the following procurement data and generate structured insights.
-
-CATEGORY: {request.category}
-
-SUPPLIER DATA:
-{suppliers_json}
+    def _build_instructions_prompt(self) -> str:
+        return """Analyze the procurement data provided below and generate structured insights.
 
 Generate a JSON response with this EXACT structure:
-{{
+{
   "category": "string (the category name)",
   "overall_risk_level": "Low OR Medium OR High",
   "key_risks": ["risk 1", "risk 2", "risk 3"],
   "negotiation_levers": ["lever 1", "lever 2", "lever 3"],
-  "recommended_actions_next_90_days": ["action 1", "action 2", "action 3"],
-  "confidence_score": 0.XX
-}}
+  "recommended_actions_next_90_days": ["action 1", "action 2", "action 3"]
+}
 
 SCORING GUIDELINES:
 - overall_risk_level: "High" if single-source dependency exists OR contracts expiring within 3 months OR delivery performance < 90%
@@ -71,105 +200,282 @@ SCORING GUIDELINES:
 - negotiation_levers: Must identify 3-5 specific leverage points (competitive alternatives, volume, contract timing, performance gaps)
 - recommended_actions_next_90_days: Must provide 3-5 concrete, time-bound actions prioritized by urgency
 
-Calculate confidence_score based on these factors:
-- Start with base 0.85 (we have complete, structured data)
-- Deduct 0.05 if only 1-2 suppliers (limited comparison basis)
-- Deduct 0.05 if any data appears inconsistent or unclear
-- Deduct 0.10 if analysis requires significant assumptions
-- Add 0.05 if there are clear, unambiguous risk signals
-
-Typical ranges:
-- 0.90-0.95: Complete data, 3+ suppliers, clear patterns
-- 0.80-0.89: Good data quality, some minor gaps or ambiguity
-- 0.70-0.79: Acceptable data, but requires some assumptions
+SUPPLIER DATA is CSV with one row per supplier and these columns:
+- name: supplier name
+- spend_usd: annual spend in USD
+- otd_pct: on-time delivery percentage
+- expiry_mo: months until contract expiry
+- single_source: true if the category depends on this supplier as a single source
+- region: supplier region
 
-For this specific dataset with 3 suppliers and complete fields, confidence should be 0.85-0.92.
+IMPORTANT: Ensure your JSON is complete and properly closed. Do not truncate the response."""
 
-IMPORTANT: Ensure your JSON is complete and properly closed. Do not truncate the response.
+    def _build_user_prompt(self, request: InsightsRequest) -> str:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerows(
+            (
+                s.supplier_name,
+                _format_number(s.annual_spend_usd),
+                _format_number(s.on_time_delivery_pct),
+                s.contract_expiry_months,
+                "true" if s.single_source_dependency else "false",
+                s.region,
+            )
+            for s in request.suppliers
+        )
+        suppliers_csv = buffer.getvalue().rstrip("\n")
+        
+        return _USER_PROMPT_TEMPLATE.format_map({"category": request.category, "suppliers": suppliers_csv})
 
-Respond with ONLY the JSON object, no other text."""
+    async def generate_insights(self, request: InsightsRequest) -> InsightsResponse:
+        rule_based = self._try_rule_based(request)
+        if rule_based is not None:
+            return rule_based
+        
+        cache_key = self._cache_key(request)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached
 
-    def generate_insights(self, request: InsightsRequest) -> InsightsResponse:
         try:
-            system_prompt = self._build_system_prompt()
             user_prompt = self._build_user_prompt(request)
             
-            full_prompt = f"{system_prompt}\n\n{user_prompt}"
-            
-            print(f"Making API call to Google Gemini...")
+            full_prompt = f"{self._prompt_prefix}\n\n{user_prompt}"
             
-            response = self.model.generate_content(full_prompt)
+            logger.debug("Making API call to Google Gemini...")
             
-            response_text = response.text.strip()
+            chunks = []
+            tracker = _BraceTracker()
+            self._ensure_async_client()
+            async with self.semaphore:
+                response = await self.model.generate_content_async(full_prompt, stream=True)
+                # The SDK reads one chunk ahead before yielding, so stopping at the
+                # closing brace saves at most one trailing chunk; the tracker's main
+                # job is repairing responses that stop before the object closes.
+                async for chunk in response:
+                    if not chunk.parts:
+                        continue
+                    text = chunk.text
+                    end = tracker.feed(text)
+                    if end >= 0:
+                        chunks.append(text[:end])
+                        break
+                    chunks.append(text)
             
-            print(f"Received response from LLM: {response_text[:200]}...")
+            response_text = "".join(chunks).strip()
             
-            if not response_text.endswith('}'):
-                print("WARNING: Response appears truncated, attempting to fix...")
-                open_braces = response_text.count('{')
-                close_braces = response_text.count('}')
-                if open_braces > close_braces:
-                    response_text += '}' * (open_braces - close_braces)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received response from LLM: %s...", response_text[:200])
             
-            response_text = self._clean_json_response(response_text)
+            if not tracker.closed:
+                logger.warning("Response appears truncated, attempting to fix...")
+                response_text = tracker.close(response_text)
             
-            response_data = json.loads(response_text)
+            if len(response_text) > _OFFLOAD_THRESHOLD_CHARS:
+                insights_response, repaired = await asyncio.to_thread(self._finalize_response, response_text, request)
+            else:
+                insights_response, repaired = self._finalize_response(response_text, request)
             
-            response_data = self._validate_and_fix_response(response_data, request.category)
-            
-            insights_response = InsightsResponse(**response_data)
+            if tracker.closed and not repaired:
+                self.cache[cache_key] = insights_response
             
             return insights_response
             
-        except json.JSONDecodeError as e:
-            print(f"JSON Decode Error: {str(e)}")
+        except orjson.JSONDecodeError as e:
+            logger.error("JSON Decode Error: %s", e)
             if 'response_text' in locals():
-                print(f"Response text was: {response_text}")
+                logger.debug("Response text was: %s", response_text)
             raise Exception(f"Failed to parse LLM response as JSON: {str(e)}")
         except AttributeError as e:
-            print(f"AttributeError: {str(e)}")
-            if 'response' in locals():
-                print(f"Response object: {response}")
-                print(f"Response dir: {dir(response)}")
+            logger.exception(
+                "Attribute access failed on response: %r",
+                getattr(response, "prompt_feedback", None) if 'response' in locals() else None,
+            )
             raise Exception(f"Error accessing response attributes: {str(e)}")
         except Exception as e:
-            print(f"Unexpected Error: {type(e).__name__}: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Unexpected Error: %s: %s", type(e).__name__, e)
             raise Exception(f"Error generating insights: {str(e)}")
     
-    def _clean_json_response(self, text: str) -> str:
-        text = text.strip()
+    def _ensure_async_client(self) -> None:
+        # GenerativeModel._async_client is private SDK state; this relies on the
+        # google-generativeai==0.8.3 pin in requirements.txt.
+        if self.model._async_client is None:
+            self.model._async_client = glm.GenerativeServiceAsyncClient(
+                transport=_keepalive_transport,
+                client_options={"api_key": self._api_key},
+                client_info=gapic_v1.client_info.ClientInfo(user_agent=f"genai-py/{genai.__version__}"),
+            )
+    
+    def _finalize_response(self, response_text: str, request: InsightsRequest) -> Tuple[InsightsResponse, bool]:
+        response_data = orjson.loads(self._extract_json_body(response_text))
+        response_data, repaired = self._validate_and_fix_response(response_data, request)
+        return InsightsResponse(**response_data), repaired
+    
+    def _extract_json_body(self, text: str) -> str:
+        start = text.find('{')
+        if start < 0:
+            return text
+        return text[start:text.rfind('}') + 1]
+    
+    def _has_clear_risk_signal(self, request: InsightsRequest) -> bool:
+        return any(
+            s.single_source_dependency or s.contract_expiry_months < 3 or s.on_time_delivery_pct < 90
+            for s in request.suppliers
+        )
+    
+    def _compute_confidence_score(self, request: InsightsRequest) -> float:
+        score = 0.85
+        if len(request.suppliers) < 3:
+            score -= 0.05
+        if self._has_clear_risk_signal(request):
+            score += 0.05
+        return round(score, 2)
+    
+    def _try_rule_based(self, request: InsightsRequest) -> Optional[InsightsResponse]:
+        suppliers = request.suppliers
+        single = len(suppliers) == 1
+        if not single and not any(
+            s.single_source_dependency and s.contract_expiry_months < 3 for s in suppliers
+        ):
+            return None
+        
+        category = request.category
+        total_spend = sum(s.annual_spend_usd for s in suppliers)
+        top = max(suppliers, key=lambda s: s.annual_spend_usd)
+        top_share = top.annual_spend_usd / total_spend
+        nearest = min(suppliers, key=lambda s: s.contract_expiry_months)
+        renewal = _format_months(nearest.contract_expiry_months)
+        worst = min(suppliers, key=lambda s: s.on_time_delivery_pct)
+        regions = sorted({s.region for s in suppliers})
+        
+        high_risks: List[Tuple[List[tuple], str]] = []
+        high_actions: List[Tuple[List[tuple], str]] = []
+        for s in sorted(suppliers, key=_urgency):
+            risk_parts: List[str] = []
+            action_parts: List[str] = []
+            keys: List[tuple] = []
+            deadline = 90
+            if s.contract_expiry_months < 3:
+                risk_parts.append(f"contract expires in {_format_months(s.contract_expiry_months)}")
+                action_parts.append("start renewal negotiation or competitive sourcing")
+                keys.append(("renewal", s.supplier_name))
+                deadline = min(deadline, 30)
+            if s.on_time_delivery_pct < 90:
+                risk_parts.append(f"on-time delivery is {_format_number(s.on_time_delivery_pct)}%, below the 90% threshold")
+                action_parts.append("agree a delivery performance improvement plan")
+                keys.append(("delivery", s.supplier_name))
+                deadline = min(deadline, 45)
+            if s.single_source_dependency and not single:
+                risk_parts.append(f"single-source dependency ({s.annual_spend_usd / total_spend:.0%} of category spend)")
+                action_parts.append("qualify an alternative supplier")
+                keys.extend((("concentration", s.supplier_name), ("alternatives", s.supplier_name)))
+                deadline = min(deadline, 60)
+            if risk_parts:
+                high_risks.append((keys, f"{s.supplier_name}: {'; '.join(risk_parts)}."))
+                high_actions.append((keys, f"{s.supplier_name}: {_join_clauses(action_parts)} (within {deadline} days)."))
         
-        if text.startswith("```json"):
-            text = text[7:]
-        elif text.startswith("```"):
-            text = text[3:]
+        if len(high_risks) > 5:
+            overflow = ", ".join(text.split(":", 1)[0] for _, text in high_risks[4:])
+            high_risks[4:] = [([], f"Also High risk: {overflow}.")]
+            high_actions[4:] = [([], f"Review contracts and delivery performance for {overflow} (within 30 days).")]
         
-        if text.endswith("```"):
-            text = text[:-3]
+        key_risks: List[str] = []
+        negotiation_levers: List[str] = []
+        actions: List[str] = []
+        covered_risks: set = set()
+        covered_levers: set = set()
+        covered_actions: set = set()
         
-        return text.strip()
+        for keys, text in high_risks:
+            _add_item(key_risks, covered_risks, keys, text)
+        for keys, text in high_actions:
+            _add_item(actions, covered_actions, keys, text)
+        
+        if single:
+            _add_item(key_risks, covered_risks, [("concentration", top.supplier_name)],
+                      f"All {category} spend is concentrated with a single supplier ({top.supplier_name}).")
+            _add_item(actions, covered_actions, [("alternatives", top.supplier_name)],
+                      f"Qualify a second {category} supplier to reduce reliance on {top.supplier_name} (within 90 days).")
+        _add_item(actions, covered_actions, [("review",)],
+                  f"Review {category} supplier performance and contract terms (within 90 days).")
+        
+        for s in sorted(suppliers, key=lambda s: s.contract_expiry_months):
+            if s.contract_expiry_months <= 6:
+                _add_item(negotiation_levers, covered_levers, [("renewal", s.supplier_name)],
+                          f"Upcoming renewal with {s.supplier_name} (in {_format_months(s.contract_expiry_months)}) creates leverage to renegotiate terms.")
+        for s in sorted(suppliers, key=lambda s: s.on_time_delivery_pct):
+            if s.on_time_delivery_pct < 95:
+                _add_item(negotiation_levers, covered_levers, [("delivery", s.supplier_name)],
+                          f"Delivery gap at {s.supplier_name} ({_format_number(s.on_time_delivery_pct)}% on time) supports service-level credits or price concessions.")
+        if single or any(s.single_source_dependency for s in suppliers):
+            _add_item(negotiation_levers, covered_levers, [("alternatives",)],
+                      "Qualifying an alternative supplier creates a credible competitive threat.")
+        _add_item(negotiation_levers, covered_levers, [("volume", top.supplier_name)],
+                  f"${top.annual_spend_usd:,.0f} annual spend with {top.supplier_name} supports volume-based pricing.")
+        
+        geography = (
+            f"All suppliers are in {regions[0]}, so the category has no geographic diversification."
+            if len(regions) == 1 else
+            f"Supply spans {len(regions)} regions ({', '.join(regions)}); disruption in any one affects part of the category."
+        )
+        fillers = (
+            (key_risks, covered_risks, [
+                (("concentration", top.supplier_name), f"{top_share:.0%} of {category} spend sits with {top.supplier_name} in {top.region}, exposing supply to disruptions in that region."),
+                (("renewal", nearest.supplier_name), f"Next contract renewal is with {nearest.supplier_name} in {renewal}; terms must be secured before then to avoid a lapse in supply."),
+                (("delivery", worst.supplier_name), f"Delivery performance needs monitoring to protect supply continuity ({worst.supplier_name} at {_format_number(worst.on_time_delivery_pct)}% on time)."),
+                (("geography",), geography),
+            ]),
+            (negotiation_levers, covered_levers, [
+                (("renewal", nearest.supplier_name), f"The renewal with {nearest.supplier_name} in {renewal} sets the window to benchmark pricing and terms."),
+                (("alternatives",), f"Credible alternatives from outside {top.region} strengthen the negotiating position with {top.supplier_name}."),
+                (("benchmark",), f"Market benchmarks for {category} pricing give an objective basis to challenge current terms."),
+            ]),
+            (actions, covered_actions, [
+                (("benchmark",), f"Benchmark {category} pricing against suppliers outside {top.region} (within 60 days)."),
+                (("renewal", nearest.supplier_name), f"Prepare the renewal strategy for {nearest.supplier_name} ahead of its contract expiry in {renewal} (within 90 days)."),
+                (("scorecard",), f"Introduce a {category} supplier scorecard tracking delivery, cost and contract dates (within 90 days)."),
+            ]),
+        )
+        for items, covered, candidates in fillers:
+            for key, text in candidates:
+                if len(items) >= 3:
+                    break
+                _add_item(items, covered, [key], text)
+        
+        if self._has_clear_risk_signal(request):
+            risk_level = RiskLevel.HIGH
+        elif top_share > 0.5 or any(s.contract_expiry_months <= 6 or s.on_time_delivery_pct < 95 for s in suppliers):
+            risk_level = RiskLevel.MEDIUM
+        else:
+            risk_level = RiskLevel.LOW
+        
+        return InsightsResponse(
+            category=category,
+            overall_risk_level=risk_level,
+            key_risks=key_risks[:5],
+            negotiation_levers=negotiation_levers[:5],
+            recommended_actions_next_90_days=actions[:5],
+            confidence_score=0.80,
+        )
     
-    def _validate_and_fix_response(self, data: Dict[str, Any], category: str) -> Dict[str, Any]:
-        if "category" not in data or not data["category"]:
-            data["category"] = category
+    def _validate_and_fix_response(self, data: Dict[str, Any], request: InsightsRequest) -> Tuple[Dict[str, Any], bool]:
+        repaired = False
+        
+        if not data.get("category"):
+            data["category"] = request.category
+            repaired = True
         
-        if "overall_risk_level" not in data:
+        if data.get("overall_risk_level") not in _RISK_LEVELS:
             data["overall_risk_level"] = "Medium"
-        else:
-            risk_level = data["overall_risk_level"]
-            if risk_level not in ["Low", "Medium", "High"]:
-                data["overall_risk_level"] = "Medium"
+            repaired = True
         
-        for list_field in ["key_risks", "negotiation_levers", "recommended_actions_next_90_days"]:
-            if list_field not in data or not isinstance(data[list_field], list) or len(data[list_field]) == 0:
+        for list_field in _LIST_FIELDS:
+            value = data.get(list_field)
+            if not value or not isinstance(value, list):
                 data[list_field] = [f"Analysis pending for {list_field.replace('_', ' ')}"]
+                repaired = True
         
-        if "confidence_score" not in data:
-            data["confidence_score"] = 0.85
-        else:
-            score = float(data["confidence_score"])
-            data["confidence_score"] = max(0.70, min(0.98, score))
+        data["confidence_score"] = self._compute_confidence_score(request)
         
-        return data
\ No newline at end of file
+        return data, repaired
\ No newline at end of file
@@ -1,9 +1,11 @@
-from fastapi import FastAPI, HTTPException, status
-from fastapi.responses import JSONResponse
+from fastapi import Body, FastAPI, HTTPException, status
+from fastapi.responses import ORJSONResponse
 from fastapi.exceptions import RequestValidationError
 from pydantic import ValidationError
 from app.models import InsightsRequest, InsightsResponse
 from app.llm_service import LLMService
+from typing import List
+import asyncio
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -12,11 +14,14 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="Procurement Insights API",
     description="Generate structured sourcing insights for procurement decision-making",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 llm_service = LLMService()
 
+MAX_BATCH_SIZE = 20
+
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request, exc):
@@ -26,7 +31,7 @@ async def validation_exception_handler(request, exc):
         message = error["msg"]
         errors.append(f"{field}: {message}")
     
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
         content={
             "error": "Validation Error",
@@ -39,7 +44,7 @@ async def validation_exception_handler(request, exc):
 @app.exception_handler(Exception)
 async def general_exception_handler(request, exc):
     logger.error(f"Unexpected error: {str(exc)}")
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content={
             "error": "Internal Server Error",
@@ -60,40 +65,9 @@ async def general_exception_handler(request, exc):
 )
 async def generate_insights(request: InsightsRequest):
     try:
-        if not request.suppliers or len(request.suppliers) == 0:
-            raise HTTPException(
-                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                detail="Supplier list cannot be empty. At least one supplier is required."
-            )
-        
-        for idx, supplier in enumerate(request.suppliers):
-            if not supplier.supplier_name or not supplier.supplier_name.strip():
-                raise HTTPException(
-                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail=f"Supplier at index {idx} has an empty or invalid name."
-                )
-            
-            if supplier.annual_spend_usd <= 0:
-                raise HTTPException(
-                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail=f"Supplier '{supplier.supplier_name}' has invalid annual spend (must be > 0)."
-                )
-            
-            if not (0 <= supplier.on_time_delivery_pct <= 100):
-                raise HTTPException(
-                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail=f"Supplier '{supplier.supplier_name}' has invalid delivery percentage (must be 0-100)."
-                )
-            
-            if supplier.contract_expiry_months < 0:
-                raise HTTPException(
-                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
-                    detail=f"Supplier '{supplier.supplier_name}' has invalid contract expiry months (must be >= 0)."
-                )
-        
         logger.info(f"Processing insights request for category: {request.category}")
         
-        insights = llm_service.generate_insights(request)
+        insights = await llm_service.generate_insights(request)
         
         logger.info(f"Successfully generated insights for category: {request.category}")
         
@@ -102,31 +76,71 @@ async def generate_insights(request: InsightsRequest):
     except HTTPException:
         raise
     
-    except ValidationError as e:
+    except Exception as e:
+        raise _to_http_exception(e)
+
+
+@app.post(
+    "/generate-insights/batch",
+    response_model=List[InsightsResponse],
+    status_code=status.HTTP_200_OK,
+    responses={
+        200: {"description": "Successfully generated procurement insights for every category"},
+        422: {"description": "Invalid input data"},
+        500: {"description": "Internal server error"}
+    }
+)
+async def generate_insights_batch(
+    requests: List[InsightsRequest] = Body(..., min_length=1, max_length=MAX_BATCH_SIZE)
+):
+    try:
+        logger.info(f"Processing batch insights request for {len(requests)} categories")
+        
+        tasks = [asyncio.ensure_future(llm_service.generate_insights(r)) for r in requests]
+        try:
+            insights = await asyncio.gather(*tasks)
+        except Exception:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        
+        logger.info(f"Successfully generated batch insights for {len(requests)} categories")
+        
+        return insights
+    
+    except HTTPException:
+        raise
+    
+    except Exception as e:
+        raise _to_http_exception(e)
+
+
+def _to_http_exception(e: Exception) -> HTTPException:
+    if isinstance(e, ValidationError):
         logger.error(f"Validation error: {str(e)}")
-        raise HTTPException(
+        return HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail=f"Data validation failed: {str(e)}"
         )
     
-    except Exception as e:
-        logger.error(f"Error generating insights: {str(e)}")
-        
-        if "API" in str(e):
-            raise HTTPException(
-                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail="LLM service is currently unavailable. Please try again later."
-            )
-        elif "JSON" in str(e):
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail="Failed to parse LLM response. Please contact support."
-            )
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"An error occurred while generating insights: {str(e)}"
-            )
+    logger.error(f"Error generating insights: {str(e)}")
+    
+    if "API" in str(e):
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="LLM service is currently unavailable. Please try again later."
+        )
+    elif "JSON" in str(e):
+        return HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to parse LLM response. Please contact support."
+        )
+    else:
+        return HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"An error occurred while generating insights: {str(e)}"
+        )
 
 
 @app.get("/health")
@@ -144,6 +158,7 @@ async def root():
         "message": "Procurement Insights API",
         "endpoints": {
             "generate_insights": "/generate-insights (POST)",
+            "generate_insights_batch": "/generate-insights/batch (POST)",
             "health": "/health (GET)",
             "docs": "/docs (GET)"
         }